@@ -1,18 +1,22 @@
 
 import os
 import logging
-import json
-import time
+import signal
+import functools
+import bisect
 import asyncio
+from types import MappingProxyType
 from datetime import datetime, timedelta
-from threading import Thread
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.date import DateTrigger
 import pytz
+import orjson
 from telegram import Bot, Update
 from telegram.ext import Application, CommandHandler, ContextTypes
-from telegram.error import TelegramError
-from flask import Flask
+from telegram.error import TelegramError, NetworkError
+from telegram.request import HTTPXRequest
+from telegram.helpers import escape_markdown
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+import uvicorn
 
 # Logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
@@ -31,34 +35,186 @@ tz = pytz.timezone(TZ)
 
 # Load timetable file (same folder)
 base_dir = os.path.dirname(__file__)
-with open(os.path.join(base_dir, "timetable.json"), "r", encoding="utf-8") as f:
-    TIMETABLE = json.load(f)
+TIMETABLE_PATH = os.path.join(base_dir, "timetable.json")
 
-scheduler = BackgroundScheduler(timezone=tz)
+@functools.lru_cache(maxsize=1)
+def _read_timetable(mtime_ns):
+    with open(TIMETABLE_PATH, "rb") as f:
+        return MappingProxyType(orjson.loads(f.read()))
 
-# Flask webserver for keeping bot alive
-app = Flask('')
+# Last timetable that loaded cleanly, used while the file is broken
+_good_timetable = MappingProxyType({})
 
-@app.route('/')
-def home():
-    return "🤖 Timetable Bot is alive! ✅"
+def load_timetable():
+    """Return a read-only view of the timetable, re-read only when the file changes
+
+    If the file is missing or fails to parse, the last good timetable is kept.
+    """
+    global _good_timetable
+    try:
+        _good_timetable = _read_timetable(os.stat(TIMETABLE_PATH).st_mtime_ns)
+    except (OSError, ValueError) as e:
+        logging.error("Could not load timetable, keeping previous one: %s", e)
+    return _good_timetable
+
+def _parse_offset(hhmm):
+    """Convert an "HH:MM" string into an offset from midnight"""
+    h, m = hhmm.split(":")
+    return timedelta(hours=int(h), minutes=int(m))
+
+# Notifications this close together are sent as one message, at the earlier
+# time. This only catches near-simultaneous events (e.g. overlapping entries);
+# a class's "5 min left" and the next class's "Next in 10 min" are always
+# 5 minutes apart, so they stay separate rather than fire early or late.
+BATCH_WINDOW = timedelta(seconds=30)
+
+def coalesce_events(events):
+    """Merge events within BATCH_WINDOW of each other into a single message"""
+    merged = []
+    for run_at, text in sorted(events, key=lambda event: event[0]):
+        if merged and run_at - merged[-1][0] <= BATCH_WINDOW:
+            merged[-1] = (merged[-1][0], merged[-1][1] + "\n" + text)
+        else:
+            merged.append((run_at, text))
+    return merged
+
+def _preprocess(timetable):
+    """Build {day: [(offset, text), ...]}, sorted by offset from midnight, once
+
+    Messages are fully formatted MarkdownV2, with subjects escaped up front.
+    """
+    week = {}
+    for day, classes in timetable.items():
+        if not classes:
+            logging.info("No classes on %s", day)
+            continue
+
+        subjects = [escape_markdown(cls["subject"], version=2) for cls in classes]
+        events = []
+        for idx, cls in enumerate(classes):
+            subject = subjects[idx]
+            start = _parse_offset(cls["start"])
+            end = _parse_offset(cls["end"])
+
+            # next class info
+            if idx + 1 < len(classes):
+                next_text = f"Next: *{subjects[idx + 1]}* at {classes[idx + 1]['start']}"
+            else:
+                next_text = "No more classes today 🎉"
+
+            events.append((start - timedelta(minutes=10),
+                           f"⏳ *Next in 10 min*: *{subject}* \\({cls['start']} – {cls['end']}\\)"))
+            events.append((start,
+                           f"🎯 *Now starting*: *{subject}* \\({cls['start']} – {cls['end']}\\)"))
+            events.append((end - timedelta(minutes=5),
+                           f"🕑 *5 min left*: *{subject}* \\(ends at {cls['end']}\\)\\.\n{next_text}"))
+        week[day] = coalesce_events(events)
+    return week
+
+@functools.lru_cache(maxsize=1)
+def _precompute(mtime_ns):
+    return _preprocess(_read_timetable(mtime_ns))
+
+def _current_schedule():
+    return _precompute(os.stat(TIMETABLE_PATH).st_mtime_ns)
+
+# Last schedule that loaded cleanly, used while the file is broken
+_good_schedule = {}
+
+def load_schedule():
+    """Return the preprocessed timetable, rebuilt only when the file changes
+
+    If the file is missing or a bad edit fails to parse, the last good
+    schedule is kept so notifications carry on.
+    """
+    global _good_schedule
+    try:
+        _good_schedule = _current_schedule()
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        logging.error("Could not load timetable, keeping previous schedule: %s", e)
+    return _good_schedule
+
+POLL_TIMEOUT = 25
+# Extra read time on top of the long poll; PTB waits POLL_TIMEOUT + this
+POLL_READ_TIMEOUT = 5
 
-def run_flask():
-    app.run(host='0.0.0.0', port=8080)
+# Adaptive backoff between empty getUpdates batches
+POLL_BACKOFF_STEP = 0.05
+POLL_BACKOFF_MAX = 5.0
 
-def keep_alive():
-    t = Thread(target=run_flask)
-    t.daemon = True
-    t.start()
+class BackoffBot(Bot):
+    """Bot that waits a little longer after each empty getUpdates batch"""
+
+    __slots__ = ("_empty_polls",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._empty_polls = 0
+
+    async def get_updates(self, *args, **kwargs):
+        updates = await super().get_updates(*args, **kwargs)
+        if updates:
+            self._empty_polls = 0
+        else:
+            self._empty_polls += 1
+            await asyncio.sleep(min(POLL_BACKOFF_STEP * self._empty_polls, POLL_BACKOFF_MAX))
+        return updates
+
+# Single bot instance, so its HTTP connection pool is reused across sends.
+# Both requests speak HTTP/2; getUpdates gets its own request so the long
+# poll never ties up a connection sendMessage is waiting for.
+BOT = BackoffBot(
+    token=BOT_TOKEN,
+    request=HTTPXRequest(http_version="2", connection_pool_size=8),
+    get_updates_request=HTTPXRequest(http_version="2", connect_timeout=10),
+)
+
+# Notifications missed by up to this much (e.g. during a restart) still fire
+MISFIRE_GRACE = timedelta(minutes=5)
+
+# Longest the dispatcher sleeps before re-reading the schedule, so edits apply
+DISPATCH_RECHECK = 60
+
+# Time of the last fired notification, kept across restarts so none is sent twice
+LAST_SENT_PATH = os.path.join(base_dir, "last_sent.txt")
+
+def read_last_sent():
+    """Return the run time of the last fired notification, or None if unknown"""
+    try:
+        with open(LAST_SENT_PATH, "r", encoding="utf-8") as f:
+            return datetime.fromisoformat(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def write_last_sent(run_at):
+    """Record the run time of the notification that just fired"""
+    try:
+        with open(LAST_SENT_PATH, "w", encoding="utf-8") as f:
+            f.write(run_at.isoformat())
+    except OSError as e:
+        logging.error("Could not record last sent notification: %s", e)
+
+# ASGI webserver for keeping bot alive, served on the bot's event loop
+api = FastAPI()
+
+@api.api_route("/", methods=["GET", "HEAD"], response_class=PlainTextResponse)
+async def home():
+    return "🤖 Timetable Bot is alive! ✅"
 
 # Global application instance
 application = None
 
+# Event loop everything runs on, and strong refs to in-flight send tasks
+BOT_LOOP = None
+PENDING = set()
+
+# Set once to stop polling, the webserver and the dispatcher
+SHUTDOWN = asyncio.Event()
+
 async def send_message_async(text):
     """Send message using async bot"""
     try:
-        bot = Bot(token=BOT_TOKEN)
-        await bot.send_message(chat_id=CHAT_ID, text=text, parse_mode="Markdown")
+        await BOT.send_message(chat_id=CHAT_ID, text=text, parse_mode="MarkdownV2")
         logging.info("Sent message: %s", text)
     except TelegramError as e:
         logging.error("TelegramError: %s", e)
@@ -66,14 +222,18 @@ async def send_message_async(text):
         logging.error("Unexpected error: %s", e)
 
 def send_message(text):
-    """Sync wrapper for sending messages"""
-    asyncio.create_task(send_message_async(text))
+    """Fire off a message on the bot loop, keeping the task alive until it finishes"""
+    task = BOT_LOOP.create_task(send_message_async(text))
+    PENDING.add(task)
+    task.add_done_callback(PENDING.discard)
+    return task
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /status command"""
-    current_time = datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S %Z")
-    today_name = datetime.now(tz).strftime("%A")
-    classes_today = len(TIMETABLE.get(today_name, []))
+    now = datetime.now(tz)
+    current_time = now.strftime("%Y-%m-%d %H:%M:%S %Z")
+    today_name = now.strftime("%A")
+    classes_today = len(load_timetable().get(today_name, []))
     
     status_text = f"🤖 *Bot Status*\n\n✅ Bot is alive and running!\n⏰ Current time: {current_time}\n📅 Today: {today_name}\n📚 Classes today: {classes_today}"
     
@@ -107,7 +267,7 @@ async def start_telegram_bot():
     global application
     
     # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = Application.builder().bot(BOT).build()
     
     # Add command handlers
     application.add_handler(CommandHandler("status", status_command))
@@ -116,127 +276,165 @@ async def start_telegram_bot():
     
     logging.info("Telegram command handlers set up")
     
-    # Initialize and start the application
-    await application.initialize()
+    # Initialize and start the application. This opens BOT's HTTP clients and
+    # calls getMe, so the test message below goes over a warm connection.
+    # bootstrap_retries only covers start_polling, so retry network errors here.
+    retry_delay = 1
+    while True:
+        try:
+            await application.initialize()
+            break
+        except NetworkError as e:
+            logging.warning("Could not reach Telegram (%s), retrying in %ss", e, retry_delay)
+            try:
+                await asyncio.wait_for(SHUTDOWN.wait(), timeout=retry_delay)
+                return
+            except asyncio.TimeoutError:
+                retry_delay = min(retry_delay * 2, 60)
     await application.start()
     
+    # Send test message
+    await send_test_message()
+    
     # Start polling
     logging.info("Starting Telegram bot polling...")
-    await application.updater.start_polling(drop_pending_updates=True)
+    await application.updater.start_polling(
+        timeout=POLL_TIMEOUT,
+        read_timeout=POLL_READ_TIMEOUT,
+        poll_interval=0.0,
+        bootstrap_retries=-1,
+        drop_pending_updates=True,
+    )
+    
+    # Start dispatching class notifications now that the bot is up
+    dispatcher = asyncio.create_task(dispatch_events())
+    dispatcher.add_done_callback(dispatcher_done)
+    logging.info("Dispatcher started")
     
-    # Keep the bot running
+    # Keep the bot running until shutdown is requested
+    await SHUTDOWN.wait()
+    logging.info("Stopping Telegram bot...")
+    dispatcher.cancel()
+    # Let in-flight sends finish before the bot's HTTP clients are closed
+    await asyncio.gather(dispatcher, *PENDING, return_exceptions=True)
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+
+    # Report a dispatcher crash as a failure of the bot
+    if not dispatcher.cancelled() and dispatcher.exception():
+        raise dispatcher.exception()
+
+def next_event(after):
+    """Return the first (run_at, text) after `after`, walking forward through the week"""
+    week = load_schedule()
+    # Offsets are wall-clock times, so compare and add them in naive local time
+    # and localize each result; this stays correct across DST changes.
+    local = after.astimezone(tz).replace(tzinfo=None)
+    for days_ahead in range(8):
+        day = local.date() + timedelta(days=days_ahead)
+        events = week.get(day.strftime("%A"))
+        if not events:
+            continue
+
+        midnight = datetime.combine(day, datetime.min.time())
+        idx = bisect.bisect_right(events, local - midnight, key=lambda event: event[0])
+        if idx < len(events):
+            offset, text = events[idx]
+            return tz.localize(midnight + offset), text
+    return None
+
+async def dispatch_events():
+    """Sleep until the next notification in the week, send it, and advance"""
+    # Start a little in the past so notifications missed during a restart still
+    # fire, but never before the last one already sent
+    last = datetime.now(tz) - MISFIRE_GRACE
+    last_sent = read_last_sent()
+    if last_sent and last_sent > last:
+        last = last_sent
+    announced = None
+    waiting = False
     while True:
-        await asyncio.sleep(1)
-
-def run_telegram_bot():
-    """Run the Telegram bot in a separate thread"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        loop.run_until_complete(start_telegram_bot())
-    except Exception as e:
-        logging.error("Telegram bot error: %s", e)
-    finally:
-        loop.close()
-
-def schedule_all_for_today():
-    today_name = datetime.now(tz).strftime("%A")
-    classes = TIMETABLE.get(today_name, [])
-    now = datetime.now(tz)
-    logging.info("Scheduling for %s — %d classes", today_name, len(classes))
-
-    for idx, cls in enumerate(classes):
-        subject = cls["subject"]
-        start_time = datetime.strptime(cls["start"], "%H:%M").time()
-        end_time = datetime.strptime(cls["end"], "%H:%M").time()
-
-        start_dt = tz.localize(datetime.combine(now.date(), start_time))
-        end_dt = tz.localize(datetime.combine(now.date(), end_time))
-
-        # compute times
-        t_before_10 = start_dt - timedelta(minutes=10)
-        t_start = start_dt
-        t_before_end_5 = end_dt - timedelta(minutes=5)
-
-        # next class info
-        if idx + 1 < len(classes):
-            next_cls = classes[idx + 1]
-            next_text = f"Next: *{next_cls['subject']}* at {next_cls['start']}"
+        event = next_event(last)
+        if event is None:
+            # Keep waiting: the timetable may gain classes after an edit
+            if not waiting:
+                logging.warning("Timetable has no classes, waiting for it to change")
+                waiting = True
+            await asyncio.sleep(DISPATCH_RECHECK)
+            continue
+
+        run_at, text = event
+        waiting = False
+        if run_at != announced:
+            logging.info("Next notification at %s", run_at.isoformat())
+            announced = run_at
+
+        # Sleep in bounded steps and look the event up again on waking, so a
+        # timetable edit made meanwhile is honoured
+        delay = (run_at - datetime.now(tz)).total_seconds()
+        if delay > 0:
+            await asyncio.sleep(min(delay, DISPATCH_RECHECK))
+            continue
+
+        # Drop notifications that are too stale to be useful (host suspend, clock jump)
+        if datetime.now(tz) - run_at > MISFIRE_GRACE:
+            logging.warning("Skipping notification for %s, missed by more than %s", run_at.isoformat(), MISFIRE_GRACE)
         else:
-            next_text = "No more classes today 🎉"
-
-        # create unique job ids
-        jid1 = f"{today_name}-{subject}-10min"
-        jid2 = f"{today_name}-{subject}-start"
-        jid3 = f"{today_name}-{subject}-5end"
-
-        # only schedule if in future (today)
-        if t_before_10 > now:
-            scheduler.add_job(send_message, trigger=DateTrigger(run_date=t_before_10),
-                              args=[f"⏳ *Next in 10 min*: *{subject}* ({cls['start']} – {cls['end']})"],
-                              id=jid1, replace_existing=True)
-            logging.info("Scheduled 10min before for %s at %s", subject, t_before_10.isoformat())
-
-        if t_start > now:
-            scheduler.add_job(send_message, trigger=DateTrigger(run_date=t_start),
-                              args=[f"🎯 *Now starting*: *{subject}* ({cls['start']} – {cls['end']})"],
-                              id=jid2, replace_existing=True)
-            logging.info("Scheduled start for %s at %s", subject, t_start.isoformat())
-
-        if t_before_end_5 > now:
-            scheduler.add_job(send_message, trigger=DateTrigger(run_date=t_before_end_5),
-                              args=[f"🕑 *5 min left*: *{subject}* (ends at {cls['end']}).\n{next_text}"],
-                              id=jid3, replace_existing=True)
-            logging.info("Scheduled 5min-before-end for %s at %s", subject, t_before_end_5.isoformat())
-
-def schedule_midnight_job():
-    tomorrow = (datetime.now(tz) + timedelta(days=1)).replace(hour=0, minute=1, second=0, microsecond=0)
-    scheduler.add_job(schedule_all_for_today, trigger=DateTrigger(run_date=tomorrow),
-                      id="schedule_tomorrow", replace_existing=True)
-    logging.info("Scheduled next-day scheduler at %s", tomorrow.isoformat())
-
-def startup_schedule():
-    schedule_all_for_today()
-    schedule_midnight_job()
+            send_message(text)
+        write_last_sent(run_at)
+        last = run_at
+
+def dispatcher_done(task):
+    """Shut down if the dispatcher dies, rather than staying up without notifications"""
+    if not task.cancelled() and task.exception():
+        logging.error("Dispatcher crashed: %s", task.exception())
+        SHUTDOWN.set()
 
 async def send_test_message():
     """Send a test message to verify the bot is working"""
-    test_text = "🤖 *Test Message*\n\nTimetable Bot is working correctly! ✅\n\nTry these commands:\n/alive - Check if bot is alive\n/status - Get detailed status\n/help - Show help"
+    test_text = "🤖 *Test Message*\n\nTimetable Bot is working correctly\\! ✅\n\nTry these commands:\n/alive \\- Check if bot is alive\n/status \\- Get detailed status\n/help \\- Show help"
     await send_message_async(test_text)
 
+async def main_async():
+    """Run the webserver, the Telegram bot and the dispatcher on one event loop"""
+    global BOT_LOOP, _good_schedule
+    BOT_LOOP = asyncio.get_running_loop()
+
+    # Fail fast on a missing or broken timetable; later bad edits fall back
+    # to this schedule instead
+    _good_schedule = _current_schedule()
+    load_timetable()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        BOT_LOOP.add_signal_handler(sig, SHUTDOWN.set)
+
+    config = uvicorn.Config(api, host="0.0.0.0", port=8080, loop="asyncio", log_level="info")
+    server = uvicorn.Server(config)
+    serving = asyncio.create_task(server.serve())
+    polling = asyncio.create_task(start_telegram_bot())
+    logging.info("Telegram bot started, webserver on port 8080")
+
+    # uvicorn may take over the signal handlers, so either task exiting stops the other
+    serving.add_done_callback(lambda task: SHUTDOWN.set())
+    polling.add_done_callback(lambda task: SHUTDOWN.set())
+
+    await SHUTDOWN.wait()
+    logging.info("Shutting down...")
+    server.should_exit = True
+    failed = False
+    for result in await asyncio.gather(serving, polling, return_exceptions=True):
+        if isinstance(result, Exception):
+            logging.error("Telegram bot error: %s", result)
+            failed = True
+
+    # Exit non-zero so hosts with a restart-on-failure policy bring the bot back
+    if failed:
+        raise SystemExit(1)
+
 def main():
     logging.info("Starting Timetable Bot")
-    
-    # Start Flask webserver in background
-    keep_alive()
-    logging.info("Webserver started on port 8080")
-    
-    # Start scheduler
-    scheduler.start()
-    logging.info("Scheduler started")
-    
-    # Send test message
-    asyncio.run(send_test_message())
-    
-    # Schedule today's classes
-    startup_schedule()
-    
-    # Start Telegram bot in a separate thread
-    bot_thread = Thread(target=run_telegram_bot)
-    bot_thread.daemon = True
-    bot_thread.start()
-    logging.info("Telegram bot thread started")
-    
-    # Keep main thread alive
-    try:
-        while True:
-            time.sleep(30)
-    except (KeyboardInterrupt, SystemExit):
-        logging.info("Shutting down...")
-        if application:
-            asyncio.run(application.stop())
-            asyncio.run(application.shutdown())
-        scheduler.shutdown()
+    asyncio.run(main_async())
 
 if __name__ == "__main__":
     main()